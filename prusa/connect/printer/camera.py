@@ -2,10 +2,10 @@
 Snapshot and Resolution"""
 
 import logging
-from copy import deepcopy
+from operator import attrgetter
 from threading import Event
 from time import time
-from typing import Any, Dict, Optional, Set
+from typing import Any, Callable, Dict, FrozenSet, Optional
 
 from requests import Session  # type: ignore
 
@@ -31,6 +31,10 @@ class Snapshot:
     endpoint = "/c/snapshot"
     method = "PUT"
 
+    # One gets made for every photo, don't give each one a __dict__
+    __slots__ = ("camera_fingerprint", "camera_id", "camera_token", "data",
+                 "printer_uuid", "timestamp")
+
     # pylint: disable=too-many-arguments
     def __init__(self):
         self.camera_token = None
@@ -74,7 +78,8 @@ class Snapshot:
                            data=self.data,
                            timeout=CONNECTION_TIMEOUT)
 
-        log.debug("%s response: %s", name, res.text)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("%s response: %s", name, res.text)
         return res
 
 
@@ -127,14 +132,58 @@ class Resolution:
         yield "height", self.height
 
 
+def _unchanged(value: Any) -> Any:
+    """The conversion for settings that need none"""
+    return value
+
+
+def _trigger_scheme_from_name(name: str) -> Any:
+    """Converts the trigger scheme name, unknown names get the default"""
+    try:
+        return TriggerScheme[name]
+    except KeyError:
+        return DEFAULT_CAMERA_SETTINGS[CapabilityType.TRIGGER_SCHEME.value]
+
+
+def _resolution_from_string(value: str) -> Resolution:
+    """Converts a <width>x<height> string to a Resolution"""
+    return Resolution(*(int(val) for val in value.split("x")))
+
+
+def _resolution_from_json(value: Dict[str, int]) -> Resolution:
+    """Converts a {"width": ..., "height": ...} dict to a Resolution"""
+    return Resolution(**value)
+
+
+# Setting value conversions, the methods converting whole settings
+# look each setting up here instead of comparing it to every capability
+_FROM_STRING: Dict[str, Callable[[Any], Any]] = {
+    CapabilityType.TRIGGER_SCHEME.value: _trigger_scheme_from_name,
+    CapabilityType.RESOLUTION.value: _resolution_from_string,
+    CapabilityType.ROTATION.value: int,
+    CapabilityType.EXPOSURE.value: float,
+    CapabilityType.FOCUS.value: float,
+}
+_FROM_JSON: Dict[str, Callable[[Any], Any]] = {
+    CapabilityType.TRIGGER_SCHEME.value: _trigger_scheme_from_name,
+    CapabilityType.RESOLUTION.value: _resolution_from_json,
+}
+_TO_STRING: Dict[str, Callable[[Any], str]] = {
+    CapabilityType.TRIGGER_SCHEME.value: attrgetter("name"),
+}
+_TO_JSON: Dict[str, Callable[[Any], Any]] = {
+    CapabilityType.TRIGGER_SCHEME.value: attrgetter("name"),
+    CapabilityType.RESOLUTION.value: dict,
+}
+
+
 def value_setter(capability_type):
     """A decorator for methods setting a camera option while making sure
     it is valid"""
     def value_setter_decorator(func):
         def inner(camera: "Camera", value):
             # pylint: disable=protected-access
-            old_value = camera.get_value(capability_type)
-            if not camera.supports(capability_type):
+            if capability_type not in camera._capabilities:
                 raise NotSupported(
                     f"The camera {camera.name} does not support setting "
                     f"{capability_type.name}")
@@ -145,6 +194,9 @@ def value_setter(capability_type):
             except Exception as exception:  # pylint: disable=broad-except
                 log.exception("Exception while setting %s",
                               capability_type.name)
+                # The setters store the new value only once the driver
+                # succeeds, so this is still the old one
+                old_value = camera.get_value(capability_type)
                 camera.disconnect()
                 raise DriverError(
                     f"The driver {camera._driver.name} failed to set the"
@@ -161,7 +213,8 @@ def value_getter(capability_type):
     """A decorator for methods getting a camera option"""
     def value_getter_decorator(func):
         def inner(camera: "Camera"):
-            if not camera.supports(capability_type):
+            # pylint: disable=protected-access
+            if capability_type not in camera._capabilities:
                 raise NotSupported(
                     f"The camera {camera.name} does not support "
                     f"{capability_type.name}")
@@ -182,7 +235,8 @@ class Camera:
     def __init__(self, driver):
         self._trigger_scheme = None
         self._resolution = None
-        self._available_resolutions = {}
+        self._output_resolution = None
+        self._available_resolutions: FrozenSet[Resolution] = frozenset()
         self._rotation = 0
         self._exposure = 0.0
         self._focus = 0.0
@@ -199,18 +253,25 @@ class Camera:
 
         self._driver = driver
         self._driver.photo_cb = self._photo_handler
+        # The camera ID does not change, neither does its fingerprint
+        self._fingerprint = make_fingerprint(driver.camera_id)
 
         self._capabilities = frozenset(self._driver.capabilities)
+        self._configurable_capabilities = self._capabilities - {
+            CapabilityType.IMAGING,
+        }
         if CapabilityType.TRIGGER_SCHEME not in self._capabilities:
             raise AttributeError(
                 "Be sure to fill out driver supported capabilities. "
                 "TRIGGER_SCHEME is the bare minimum")
 
         if self.supports(CapabilityType.RESOLUTION):
-            self._available_resolutions = self._driver.available_resolutions
+            self._available_resolutions = frozenset(
+                self._driver.available_resolutions)
 
         # - Initial settings -
-        initial_settings = deepcopy(DEFAULT_CAMERA_SETTINGS)
+        # The default values are immutable, a shallow copy is enough
+        initial_settings = dict(DEFAULT_CAMERA_SETTINGS)
 
         config = self._driver.config
         driver_settings = self.settings_from_string(config)
@@ -233,11 +294,11 @@ class Camera:
 
     def get_value(self, capability_type: CapabilityType):
         """Calls the getter for the value specified by CapabilityType"""
-        return getattr(self, str(capability_type.value))
+        return getattr(self, capability_type.value)
 
     def set_value(self, capability_type: CapabilityType, value: Any):
         """Calls the setter for the value specified by CapabilityType"""
-        setattr(self, str(capability_type.value), value)
+        setattr(self, capability_type.value, value)
 
     @property
     @value_getter(CapabilityType.TRIGGER_SCHEME)
@@ -270,6 +331,7 @@ class Camera:
             raise ValueError(f"Resolution {resolution} is not available")
         self._driver.set_resolution(resolution)
         self._resolution = resolution
+        self._update_output_resolution()
 
     @property
     @value_getter(CapabilityType.ROTATION)
@@ -285,6 +347,7 @@ class Camera:
             raise ValueError(f"Rotation of {rotation}° is not allowed")
         self._driver.set_rotation(rotation)
         self._rotation = rotation
+        self._update_output_resolution()
 
     @property
     @value_getter(CapabilityType.EXPOSURE)
@@ -336,7 +399,7 @@ class Camera:
     @property
     def configurable_capabilities(self):
         """Returns capabilities with a configurable attribute"""
-        return self._capabilities - {CapabilityType.IMAGING}
+        return self._configurable_capabilities
 
     @property
     def is_busy(self):
@@ -364,7 +427,7 @@ class Camera:
     @property
     def fingerprint(self):
         """Returns the camera ID as a fingerprint for connect"""
-        return make_fingerprint(self.camera_id)
+        return self._fingerprint
 
     @property
     def is_registered(self):
@@ -411,15 +474,12 @@ class Camera:
 
     @property
     def output_resolution(self):
-        """Returns the expected resolution of the output image"""
-        if not self.supports(CapabilityType.RESOLUTION):
-            return None
-        if self.rotation in {90, 270}:
-            return reversed(self.resolution)
-        return self.resolution
+        """Returns the expected resolution of the output image
+        None if the camera does not support resolution"""
+        return self._output_resolution
 
     @property
-    def available_resolutions(self) -> Set[Resolution]:
+    def available_resolutions(self) -> FrozenSet[Resolution]:
         """Gets the camera's available resolutions"""
         return self._available_resolutions
 
@@ -431,7 +491,7 @@ class Camera:
         """Sets the camera settings according to the given dict
         The dictionary has to contain compatible values, convert them ahead of
         time using the string and json conversion methods"""
-        for capability_type in self.configurable_capabilities:
+        for capability_type in self._configurable_capabilities:
             capability_name = capability_type.value
             if capability_name not in new_settings:
                 continue
@@ -449,69 +509,37 @@ class Camera:
     def settings_from_string(src_settings: Dict[str, str]):
         """Converts settings from one format into a dictionary with
         Capability compatible values"""
-        settings = {}
-        for setting, src_value in src_settings.items():
-            value: Any = src_value
-            if setting == CapabilityType.TRIGGER_SCHEME.value:
-                try:
-                    value = TriggerScheme[src_value]
-                except KeyError:
-                    value = DEFAULT_CAMERA_SETTINGS[
-                        CapabilityType.TRIGGER_SCHEME.value]
-            elif setting == CapabilityType.RESOLUTION.value:
-                value = Resolution(*(int(val) for val in src_value.split("x")))
-            elif setting == CapabilityType.ROTATION.value:
-                value = int(src_value)
-            elif setting == CapabilityType.EXPOSURE.value:
-                value = float(src_value)
-            elif setting == CapabilityType.FOCUS.value:
-                value = float(src_value)
-            settings[setting] = value
-        return settings
+        return {
+            setting: _FROM_STRING.get(setting, _unchanged)(src_value)
+            for setting, src_value in src_settings.items()
+        }
 
     @staticmethod
     def settings_from_json(src_settings: Dict[str, Any]):
         """Converts settings from one format into a dictionary with
         Capability compatible values"""
-        settings = {}
-        for setting, src_value in src_settings.items():
-            value = src_value
-            if setting == CapabilityType.TRIGGER_SCHEME.value:
-                try:
-                    value = TriggerScheme[src_value]
-                except KeyError:
-                    value = DEFAULT_CAMERA_SETTINGS[
-                        CapabilityType.TRIGGER_SCHEME.value]
-            elif setting == CapabilityType.RESOLUTION.value:
-                value = Resolution(**src_value)
-            settings[setting] = value
-        return settings
+        return {
+            setting: _FROM_JSON.get(setting, _unchanged)(src_value)
+            for setting, src_value in src_settings.items()
+        }
 
     @staticmethod
     def string_from_settings(src_settings: Dict[str, Any]):
         """Converts settings from one format into a dictionary with
         Capability compatible values"""
-        settings = {}
-        for setting, src_value in src_settings.items():
-            value = str(src_value)
-            if setting == CapabilityType.TRIGGER_SCHEME.value:
-                value = src_value.name
-            settings[setting] = value
-        return settings
+        return {
+            setting: _TO_STRING.get(setting, str)(src_value)
+            for setting, src_value in src_settings.items()
+        }
 
     @staticmethod
     def json_from_settings(src_settings: Dict[str, Any]):
         """Converts settings from one format into a dictionary with
         Capability compatible values"""
-        settings = {}
-        for setting, src_value in src_settings.items():
-            value = src_value
-            if setting == CapabilityType.TRIGGER_SCHEME.value:
-                value = src_value.name
-            elif setting == CapabilityType.RESOLUTION.value:
-                value = dict(src_value)
-            settings[setting] = value
-        return settings
+        return {
+            setting: _TO_JSON.get(setting, _unchanged)(src_value)
+            for setting, src_value in src_settings.items()
+        }
 
     def get_settings(self):
         """Gets the object representation of settings for conversion"""
@@ -544,8 +572,18 @@ class Camera:
         snapshot.camera_token = self.token
         self.photo_cb(snapshot)
         self._become_ready()
-        log.debug("A camera %s has taken a photo. (%s bytes)", self.name,
-                  len(snapshot.data))
+        # The name comes from the driver config, don't look it up for nothing
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("A camera %s has taken a photo. (%s bytes)", self.name,
+                      len(snapshot.data))
+
+    def _update_output_resolution(self):
+        """Re-computes the output resolution after the resolution
+        or rotation changes. A sideways image has the sides swapped"""
+        if self._resolution is not None and self._rotation in {90, 270}:
+            self._output_resolution = reversed(self._resolution)
+        else:
+            self._output_resolution = self._resolution
 
     def _become_busy(self):
         """Makes the camera become busy"""
@@ -1,9 +1,24 @@
 """Implements the camera config management class"""
 import logging
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
-from copy import deepcopy
-from multiprocessing import RLock
-from typing import Dict, List, Set, Tuple, Type
+from contextlib import contextmanager
+from hashlib import blake2b
+from io import StringIO
+from itertools import chain
+from threading import Lock, RLock
+from typing import (
+    Dict,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+)
 
 from . import CameraController
 from .camera import Camera
@@ -43,6 +58,8 @@ class CameraConfigurator:
         self.config = config
         self.config_file_path = config_file_path
         self.lock = RLock()
+        # Serializes camera scans, see load_cameras
+        self._scan_lock = Lock()
         self.drivers: Dict[str, Type[CameraDriver]] = {
             driver.name: driver
             for driver in drivers
@@ -51,14 +68,32 @@ class CameraConfigurator:
 
         # Camera drivers that are loaded - even broken ones
         self.loaded: Dict[str, CameraDriver] = {}
+        # IDs of the loaded cameras with connected drivers
+        self._connected: Set[str] = set()
         # A set of camera id's that are stored in the config
         # We know the order of these cameras
         self.stored: Set[str] = set()
         self.detected: Set[str] = set()
+        # The union of stored and detected, kept in sync with them
+        self._known: Set[str] = set()
         # Config hashes of detected cameras for comparison with stored ones
         self.hash_to_detected: Dict[str, str] = {}
-        # A list of camera IDs in descending order of importance
-        self.order: List[str] = []
+        # Camera IDs in descending order of importance
+        # A dict is used as an ordered set, values are always None
+        self._order: Dict[str, None] = {}
+        # The order as it is in the config, to skip storing it unchanged
+        self._stored_order: Tuple[str, ...] = ()
+        # Plain dict copies of the camera config sections, so we don't have
+        # to query the slow ConfigParser. Keep in sync with the config!
+        self._section_cache: Dict[str, Dict[str, str]] = {}
+        # Hashes of the configs last stored using store()
+        self._stored_hashes: Dict[str, int] = {}
+
+        # Config writes get postponed until the outermost batch ends
+        self._write_depth = 0
+        self._dirty = False
+        # Digest of the last written config, to skip identical writes
+        self._written_digest = b""
 
         self._already_loaded_configs = False
 
@@ -66,13 +101,16 @@ class CameraConfigurator:
 
     # --- Public ----
 
+    @property
+    def order(self) -> List[str]:
+        """A list of camera IDs in descending order of importance"""
+        return list(self._order)
+
     def is_connected(self, camera_id: str) -> bool:
         """Is the camera already loaded and working?"""
         # Don't answer until any ongoing operation is done
         with self.lock:
-            if camera_id not in self.loaded:
-                return False
-            return self.loaded[camera_id].is_connected
+            return camera_id in self._connected
 
     def add_camera(self, camera_id: str, config: Dict[str, str]) -> None:
         """Adds a camera into the configurator instance and if it works
@@ -83,7 +121,7 @@ class CameraConfigurator:
         if self.is_connected(camera_id):
             raise CameraAlreadyConnected(f"A camera with id {camera_id} "
                                          f"seems to be already working")
-        with self.lock:
+        with self.lock, self._batched_write():
             if not self._is_config_valid(config):
                 raise ConfigError(f"Camera config is not valid {config}")
             # If valid, store the config
@@ -94,38 +132,21 @@ class CameraConfigurator:
         """Loads the cameras from config
         Run with load_configs = True only once!
         """
-        with self.lock:
-            if load_configs:
-                if self._already_loaded_configs:
-                    raise RuntimeError(
-                        "Loading configs more than once is not supported")
-                self._already_loaded_configs = True
-                self.order, config_dict = self._get_configs()
-                self.stored = set(config_dict)
-                self._update_order()
-            else:
-                config_dict = self._get_loaded_configs()
-
-            detected_configs = {}
+        # Scanning can take a while, so it's done without holding the lock,
+        # not to block everyone else. The scan lock makes sure scans
+        # get committed in the same order they were made in
+        with self._scan_lock:
+            detected_configs: CameraConfigs = {}
             if self.auto_detect:
                 detected_configs = self._get_detected_cameras()
-                self.detected = set(detected_configs.keys())
-                self.hash_to_detected = self._extract_hash_pairings(
-                    detected_configs)
-                self._update_order()
 
-            updated_configs = self._get_updated_configs(
-                config_dict, detected_configs)
-            # Filters additional detected cameras while already running
-            new_configs = self._filter_new_configs(updated_configs)
-
-            for camera_id, config in new_configs.items():
-                self._load_driver(camera_id, config)
+            with self.lock, self._batched_write():
+                self._load_cameras(detected_configs, load_configs)
 
     def reset_to_defaults(self, camera_id: str) -> None:
         """Resets any camera to default settings -
         removes its non-essential config values"""
-        with self.lock:
+        with self.lock, self._batched_write():
             if camera_id not in self.loaded:
                 raise CameraNotFound("Cannot factory reset non-loaded cameras")
 
@@ -146,7 +167,7 @@ class CameraConfigurator:
 
     def remove_camera(self, camera_id: str) -> None:
         """If the camera is not detected, removes it from everywhere"""
-        with self.lock:
+        with self.lock, self._batched_write():
             if camera_id in self.detected:
                 raise RuntimeError("Cannot remove an auto added camera. "
                                    "It would just re-add itself anyway.")
@@ -154,74 +175,129 @@ class CameraConfigurator:
 
     def store_order(self):
         """Stores the current camera order into the config"""
-        with self.lock:
+        with self.lock, self._batched_write():
+            order = tuple(self._order)
+            if order == self._stored_order:
+                return
             self.config.remove_section("camera_order")
             self.config.add_section("camera_order")
-            for i, camera_id in enumerate(self.order, start=1):
+            for i, camera_id in enumerate(order, start=1):
                 self.config.set(section="camera_order",
                                 option=str(i),
                                 value=camera_id)
-
-            self._write_config()
+            self._stored_order = order
+            self._dirty = True
 
     def set_order(self, order: List[str]) -> None:
         """Moves the specified ids to the front, does not add any"""
-        with self.lock:
-            new_order = []
-            known_cameras = self.stored.union(self.detected)
+        with self.lock, self._batched_write():
             # Put new ones that are configured at the start
-            for camera_id in order:
-                if camera_id not in known_cameras:
-                    continue
-                new_order.append(camera_id)
+            new_order = dict.fromkeys(camera_id for camera_id in order
+                                      if camera_id in self._known)
+            # Copy over the rest, the ones already present keep their place
+            new_order.update(self._order)
 
-            # Copy over the rest of the list
-            for camera_id in self.order:
-                if camera_id not in new_order:
-                    new_order.append(camera_id)
-
-            self.order = new_order
-            self.camera_controller.set_camera_order(self.order)
-            self.store_order()
+            self._order = new_order
+            self._propagate_order()
 
     def store(self, camera_id: str) -> None:
         """Adds the loaded camera to the config"""
         if camera_id not in self.loaded:
             raise CameraNotFound("Cannot store an unknown camera")
-        with self.lock:
+        with self.lock, self._batched_write():
             loaded_driver = self.loaded[camera_id]
             config = loaded_driver.config
 
+            # Drivers tend to ask us to store the same settings repeatedly
+            config_hash = hash(frozenset(config.items()))
+            if self._stored_hashes.get(camera_id) == config_hash:
+                return
             self._store_config(camera_id, config)
+            self._stored_hashes[camera_id] = config_hash
 
     # --- Private ---
 
+    def _load_cameras(self, detected_configs: CameraConfigs,
+                      load_configs: bool) -> None:
+        """Loads the cameras from config and the detected ones,
+        see load_cameras"""
+        if load_configs:
+            if self._already_loaded_configs:
+                raise RuntimeError(
+                    "Loading configs more than once is not supported")
+            self._already_loaded_configs = True
+            order, config_dict = self._get_configs()
+            self._order = dict.fromkeys(order)
+            self.stored = set(config_dict)
+            self._known = self.stored | self.detected
+        else:
+            config_dict = self._get_loaded_configs()
+
+        if self.auto_detect:
+            self.detected = set(detected_configs.keys())
+            self._known = self.stored | self.detected
+            self.hash_to_detected = self._extract_hash_pairings(
+                detected_configs)
+
+        # Update the order once everything is known
+        if load_configs or self.auto_detect:
+            self._update_order()
+
+        updated_configs = self._get_updated_configs(config_dict,
+                                                    detected_configs)
+        # Filters additional detected cameras while already running
+        new_configs = self._filter_new_configs(updated_configs)
+
+        # Re-use the config hashes computed for the detected cameras
+        detected_hashes = {
+            camera_id: config_hash
+            for config_hash, camera_id in self.hash_to_detected.items()
+        }
+        for camera_id, config in new_configs.items():
+            self._load_driver(camera_id, config,
+                              detected_hashes.get(camera_id))
+
     def _remove_camera(self, camera_id: str) -> None:
         """Removes the camera from absolutely everywhere"""
-        if camera_id in self.camera_controller:
-            camera = self.camera_controller.get_camera(camera_id)
+        camera = self.camera_controller.pop_camera(camera_id)
+        if camera is not None:
             camera.disconnect()
         if camera_id in self.loaded:
             del self.loaded[camera_id]
+        self._connected.discard(camera_id)
+        self._stored_hashes.pop(camera_id, None)
         if camera_id in self.stored:
             self.stored.remove(camera_id)
+            if camera_id not in self.detected:
+                self._known.discard(camera_id)
         section_name = f"camera::{camera_id}"
-        if self.config.has_section(section_name):
+        if self._section_cache.pop(section_name, None) is not None:
             self.config.remove_section(section_name)
-        self._write_config()
+        self._dirty = True
         self._update_order()
 
     def _get_detected_cameras(self) -> CameraConfigs:
-        """Asks all drivers to detect cameras, returns their configs"""
+        """Asks all drivers to detect cameras, returns their configs
+        The drivers scan in parallel, as scanning mostly waits for I/O"""
         scanned: Dict[str, Dict[str, str]] = {}
-        for driver in self.drivers.values():
-            scanned.update(driver.scan())
+        if not self.drivers:
+            return scanned
+        with ThreadPoolExecutor(max_workers=len(self.drivers),
+                                thread_name_prefix="CameraScan") as executor:
+            # map keeps the driver order, so the results merge as before
+            for driver_scanned in executor.map(lambda driver: driver.scan(),
+                                               self.drivers.values()):
+                scanned.update(driver_scanned)
 
         return scanned
 
     def _disconnected_handler(self, loaded_driver: CameraDriver) -> None:
         """This camera is defunct, remove it from SDK cameras"""
-        self.camera_controller.remove_camera(loaded_driver.camera_id)
+        camera_id = loaded_driver.camera_id
+        # A replaced driver must not disconnect its successor
+        if self.loaded.get(camera_id) is loaded_driver:
+            self._connected.discard(camera_id)
+            self.camera_controller.remove_camera(camera_id)
 
     def _extract_hash_pairings(self, config_dict: CameraConfigs):
         hash_pairings = {}
@@ -240,12 +316,11 @@ class CameraConfigurator:
 
     def _filter_new_configs(self, config_dict: CameraConfigs) -> CameraConfigs:
         """Only allow configs for unknown or broken cameras"""
-        new_configs = {}
-        for camera_id, config in config_dict.items():
-            if not self.is_connected(camera_id):
-                new_configs[camera_id] = config
-
-        return new_configs
+        return {
+            camera_id: config
+            for camera_id, config in config_dict.items()
+            if not self.is_connected(camera_id)
+        }
 
     def _get_updated_configs(self, config_dict: CameraConfigs,
                              detected_configs: CameraConfigs) -> CameraConfigs:
@@ -253,15 +328,24 @@ class CameraConfigurator:
 
         If we detect a camera with the same ID we update its config,
         for example path, to reflect this change"""
-        config_dict = deepcopy(config_dict)
+        # The camera configs are not modified, only replaced by updated
+        # copies, so a shallow copy is enough
+        config_dict = dict(config_dict)
         for camera_id, config in detected_configs.items():
             if camera_id not in config_dict:
                 config_dict[camera_id] = config
             else:
                 driver = self.drivers[config["driver"]]
-                for setting_name, setting in config.items():
-                    if setting_name in driver.REQUIRES_SETTINGS:
-                        config_dict[camera_id][setting_name] = setting
+                # Let the key views intersect, that's done in C
+                detected_settings = {
+                    setting_name: config[setting_name]
+                    for setting_name in driver.REQUIRES_SETTINGS.keys()
+                    & config.keys()
+                }
+                config_dict[camera_id] = {
+                    **config_dict[camera_id],
+                    **detected_settings,
+                }
         # Return only configs, that were auto-detected or stored
         filtered_configs: CameraConfigs = {}
         for camera_id, config in config_dict.items():
@@ -274,20 +358,31 @@ class CameraConfigurator:
         order = []
         if not self.config.has_section("camera_order"):
             self.config.add_section("camera_order")
-        indexes = list(sorted(self.config.options("camera_order")))
+        # Camera IDs don't use interpolation, so get them raw all at once
+        numbered = []
+        for index, camera_id in self.config.items("camera_order", raw=True):
+            if not index.isdigit():
+                log.warning(
+                    "Ignoring camera order index %s, it's not a "
+                    "number", index)
+                continue
+            numbered.append((int(index), camera_id))
+        # Sort numerically, so "10" does not end up before "2"
         # Lose absolute numbering
-        for index in indexes:
-            camera_id = self.config.get(section="camera_order", option=index)
+        for _, camera_id in sorted(numbered):
             order.append(camera_id)
+        self._stored_order = tuple(order)
 
         # Load actual settings
+        self._section_cache = {
+            name: dict(self.config.items(name, raw=True))
+            for name in self.config.sections() if name.startswith("camera::")
+        }
         config_dict = {}
-        for name in self.config.sections():
-            if not name.startswith("camera::"):
-                continue
+        for name, section in self._section_cache.items():
             camera_id = name.split("::", maxsplit=1)[-1]
 
-            config = dict(self.config.items(name))
+            config = dict(section)
             if not self._is_config_valid(config):
                 log.warning(
                     "Skipping loading config for camera ID: "
@@ -315,28 +410,39 @@ class CameraConfigurator:
     def _update_order(self) -> None:
         """Makes order reflect known stored and detected cameras,
         propagates any changes into the controller and the config"""
-        known_cameras = self.stored.union(self.detected)
-        for camera_id in known_cameras:
-            if camera_id not in self.order:
-                self.order.append(camera_id)
+        self._order = {
+            camera_id: None
+            for camera_id in self._order if camera_id in self._known
+        }
+        # Appends only the missing ones, stored cameras go first
+        for camera_id in chain(self.stored, self.detected):
+            self._order.setdefault(camera_id)
 
-        for camera_id in self.order:
-            if camera_id not in known_cameras:
-                self.order.remove(camera_id)
+        self._propagate_order()
 
-        self.camera_controller.set_camera_order(self.order)
+    def _propagate_order(self) -> None:
+        """Passes the current order to the controller and the config"""
+        # Hand out an immutable snapshot, the order keeps changing
+        self.camera_controller.set_camera_order(tuple(self._order))
         self.store_order()
 
-    def _load_driver(self, camera_id: str, config: Dict[str, str]) -> None:
+    def _load_driver(self,
+                     camera_id: str,
+                     config: Dict[str, str],
+                     config_hash: Optional[str] = None) -> None:
         """Loads the camera's driver and if the camera's config is not
         conflicting with any detected one, tries connecting to it.
-         If all goes well, passes the it to the CameraController as working"""
+         If all goes well, passes the it to the CameraController as working
+        Pass the config_hash if it's already known to avoid re-computing it
+        """
         driver = self.drivers[config["driver"]]
-        config_hash = driver.get_config_hash(config)
+        if config_hash is None:
+            config_hash = driver.get_config_hash(config)
 
         loaded_driver = driver(camera_id, config, self._disconnected_handler)
         loaded_driver.store_cb = self.store
         self.loaded[camera_id] = loaded_driver
+        self._connected.discard(camera_id)
 
         # Proceed only if there's no detected camera with the same config,
         # unless we are that camera
@@ -346,25 +452,88 @@ class CameraConfigurator:
         loaded_driver.connect()
 
         if loaded_driver.is_connected:
+            self._connected.add(camera_id)
             camera = Camera(loaded_driver)
             self.camera_controller.add_camera(camera)
             # Take the first photo right away
             camera.trigger_a_photo()
 
-    def _store_config(self, camera_id: str, config: Dict[str, str]) -> None:
+    def _store_config(self, camera_id: str, config: Mapping[str, str]) -> None:
         """Stores the config given to it, doesn't validate"""
         section_name = f"camera::{camera_id}"
+        self._stored_hashes.pop(camera_id, None)
 
-        if not self.config.has_section(section_name):
+        # Convert the keys and values the same way read_dict would
+        new_values = {
+            self.config.optionxform(str(key)): str(value)
+            for key, value in config.items()
+        }
+        cached = self._section_cache.get(section_name)
+        if cached is None:
             self.config.add_section(section_name)
-
-        self.config.read_dict({section_name: config})
+            cached = self._section_cache[section_name] = {}
+            self._dirty = True
+
+        changed = new_values.items() - cached.items()
+        for key, value in changed:
+            self.config.set(section_name, key, value)
+            cached[key] = value
+        if changed:
+            self._dirty = True
         self.stored.add(camera_id)
-        self._write_config()
+        self._known.add(camera_id)
 
         self._update_order()
 
+    @contextmanager
+    def _batched_write(self) -> Iterator[None]:
+        """Makes the config changes made inside this context get written
+        to the file only once, when the outermost batch ends.
+        Changes are marked by setting self._dirty"""
+        self._write_depth += 1
+        try:
+            yield
+        finally:
+            self._write_depth -= 1
+            if not self._write_depth and self._dirty:
+                self._write_config()
+
     def _write_config(self) -> None:
-        """Writes the current ConfigParser config instance to the file"""
-        with open(self.config_file_path, 'w', encoding='utf-8') as config_file:
-            self.config.write(config_file)
+        """Writes the current ConfigParser config instance to the file
+
+        The config is serialized into memory first and written out in one go
+        into a temporary file, which then atomically replaces the original,
+        so a crash can't leave a truncated config behind"""
+        self._dirty = False
+        buffer = StringIO()
+        self.config.write(buffer)
+        data = buffer.getvalue()
+        digest = blake2b(data.encode("utf-8")).digest()
+        if digest == self._written_digest:
+            return
+
+        # Replace the file a symlink points to, not the symlink itself
+        path = os.path.realpath(self.config_file_path)
+        if os.path.exists(path) and not os.path.isfile(path):
+            # Special files like /dev/null can't be replaced
+            with open(path, 'w', encoding='utf-8') as config_file:
+                config_file.write(data)
+            self._written_digest = digest
+            return
+
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as config_file:
+                config_file.write(data)
+                # Make sure the data is on the disk before replacing
+                # the old file
+                config_file.flush()
+                os.fsync(config_file.fileno())
+            if os.path.exists(path):
+                shutil.copymode(path, tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            # Don't leave the temporary file behind if anything failed
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self._written_digest = digest
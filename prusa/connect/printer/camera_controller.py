@@ -1,15 +1,20 @@
 """Implementation of CameraController"""
 import logging
-from functools import partial
-from queue import Empty, Queue
-from time import time
-from typing import Callable, Dict, Iterator, List, Optional, Set
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty, Full, Queue
+from threading import BoundedSemaphore
+from time import monotonic
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
 
 from requests import Session  # type: ignore
+from requests.adapters import HTTPAdapter  # type: ignore
+from urllib3.util.retry import Retry  # type: ignore
 
 from .camera import Camera, Snapshot
 from .const import (
-    TIMESTAMP_PRECISION,
+    SNAPSHOT_POOL_SIZE,
+    SNAPSHOT_QUEUE_SIZE,
+    SNAPSHOT_SENDERS,
     TRIGGER_SCHEME_TO_SECONDS,
     CameraBusy,
     TriggerScheme,
@@ -35,43 +40,86 @@ class CameraController:
         # A callback for sending LoopObjects to Connect
         self.send_cb = send_cb
         self.session = session
+        # Keep enough connections alive for all cameras to send snapshots
+        # without reconnecting. Retry snapshot uploads (PUT) on
+        # a temporarily unavailable server, the status is handled after
+        # the last try. Mounted only for the snapshot URL, so the rest
+        # of the printer's requests are sent as before
+        retry = Retry(total=3,
+                      backoff_factor=0.2,
+                      status_forcelist=(502, 503, 504),
+                      allowed_methods=frozenset({"PUT"}),
+                      raise_on_status=False)
+        self._snapshot_adapter = HTTPAdapter(
+            pool_connections=SNAPSHOT_POOL_SIZE,
+            pool_maxsize=SNAPSHOT_POOL_SIZE,
+            max_retries=retry)
+        self._server: Optional[str] = None
         self.server = server
         # pylint: disable=unsubscriptable-object
-        self.snapshot_queue: Queue[Snapshot] = Queue()
+        self.snapshot_queue: Queue[Optional[Snapshot]] = Queue(
+            maxsize=SNAPSHOT_QUEUE_SIZE)
+        self._running = False
 
         self._cameras: Dict[str, Camera] = {}
-        self._camera_order: List[str] = []
-        self._trigger_piles: Dict[TriggerScheme, Set[Camera]] = {
-            scheme: set()
+        self._camera_order: Tuple[str, ...] = ()
+        self._ordered_cameras: Tuple[Camera, ...] = ()
+        self._trigger_piles: Dict[TriggerScheme, Dict[str, Camera]] = {
+            scheme: {}
             for scheme in TriggerScheme
         }
 
         # --- triggers ---
         self._layer_trigger_counter = 0
-        self._last_trigger = {}
-        self._time_triggers = {}
-        for trigger_scheme in TRIGGER_SCHEME_TO_SECONDS:
-            self._time_triggers[trigger_scheme] = partial(
-                self._interval_elapsed, trigger_scheme)
-            self._last_trigger[trigger_scheme] = time()
-        self._running = False
+        # Monotonic, so setting the clock doesn't skip or repeat triggers
+        now = monotonic()
+        self._time_schemes: List[Tuple[TriggerScheme, float]] = list(
+            TRIGGER_SCHEME_TO_SECONDS.items())
+        self._trigger_deadlines: Dict[TriggerScheme, float] = {
+            scheme: now + interval
+            for scheme, interval in self._time_schemes
+        }
+        # The earliest of the above, most ticks need to check only this
+        self._next_deadline = min(self._trigger_deadlines.values())
+
+    @property
+    def server(self) -> Optional[str]:
+        """Connect server URL"""
+        return self._server
+
+    @server.setter
+    def server(self, server: Optional[str]) -> None:
+        """Sets the Connect server URL, moves the snapshot adapter
+        to its snapshot URL"""
+        if self._server is not None:
+            self.session.adapters.pop(self._server + Snapshot.endpoint, None)
+        self._server = server
+        if server is not None:
+            self.session.mount(server + Snapshot.endpoint,
+                               self._snapshot_adapter)
 
     def add_camera(self, camera: Camera) -> None:
         """Adds a camera. This camera has to be functional"""
         camera_id = camera.camera_id
         self._cameras[camera_id] = camera
-        self._trigger_piles[camera.trigger_scheme].add(camera)
+        self._trigger_piles[camera.trigger_scheme][camera_id] = camera
         camera.scheme_cb = self.scheme_handler
         camera.photo_cb = self.photo_handler
+        self._update_ordered_cameras()
 
     def remove_camera(self, camera_id: str) -> None:
         """Removes the camera, either on request, or because it became
         disconnected, removes """
-        if camera_id not in self._cameras:
-            return
-        camera = self._cameras[camera_id]
-        self._trigger_piles[camera.trigger_scheme].remove(camera)
-        del self._cameras[camera_id]
+        self.pop_camera(camera_id)
+
+    def pop_camera(self, camera_id: str) -> Optional[Camera]:
+        """Removes the camera and returns it
+        Returns None if there's no camera with such ID"""
+        camera = self._cameras.pop(camera_id, None)
+        if camera is not None:
+            self._trigger_piles[camera.trigger_scheme].pop(camera_id, None)
+            self._update_ordered_cameras()
+        return camera
 
     def get_camera(self, camera_id: str) -> Camera:
         """Gets the camera by its ID"""
@@ -98,31 +146,32 @@ class CameraController:
     @property
     def cameras_in_order(self) -> Iterator[Camera]:
         """Iterates over functional cameras in the configured order"""
-        for camera_id in self._camera_order:
-            if camera_id in self._cameras:
-                yield self._cameras[camera_id]
+        return iter(self._ordered_cameras)
 
-    def set_camera_order(self, camera_order: List[str]) -> None:
+    def set_camera_order(self, camera_order: Sequence[str]) -> None:
         """Usually called by the CameraConfigurator to order
-        the SDK cameras"""
-        self._camera_order = camera_order
+        the SDK cameras. Keeps an immutable copy, passing a tuple
+        avoids copying it"""
+        self._camera_order = tuple(camera_order)
+        self._update_ordered_cameras()
+
+    def _update_ordered_cameras(self) -> None:
+        """Re-builds the ordered functional cameras after the cameras
+        or their order change"""
+        cameras = self._cameras
+        self._ordered_cameras = tuple(cameras[camera_id]
+                                      for camera_id in self._camera_order
+                                      if camera_id in cameras)
 
     def register_camera(self, camera_id: str) -> None:
         """Passes the camera to SDK for registration"""
-        if camera_id not in self._cameras:
+        camera = self._cameras.get(camera_id)
+        if camera is None:
             log.warning(
                 "Tried registering a camera id: %s that's not "
                 "tracked by this controller", camera_id)
             return
-        self.send_cb(CameraRegister(self.get_camera(camera_id)))
-
-    def _interval_elapsed(self, trigger_scheme) -> bool:
-        """Is it time to trigger the time based trigger scheme pile?"""
-        interval = TRIGGER_SCHEME_TO_SECONDS[trigger_scheme]
-        if time() - self._last_trigger[trigger_scheme] < interval:
-            return False
-        self._last_trigger[trigger_scheme] = time()
-        return True
+        self.send_cb(CameraRegister(camera))
 
     def layer_trigger(self):
         """Called every layer, triggers the layer dependant trigger schemes"""
@@ -135,14 +184,20 @@ class CameraController:
     def tick(self) -> None:
         """Called periodically by the SDK to let us trigger cameras when it's
         the right time"""
-        for scheme, trigger in self._time_triggers.items():
-            if trigger():
+        now = monotonic()
+        if now < self._next_deadline:
+            return
+        for scheme, interval in self._time_schemes:
+            if now >= self._trigger_deadlines[scheme]:
+                self._trigger_deadlines[scheme] = now + interval
                 self.trigger_pile(scheme)
+        self._next_deadline = min(self._trigger_deadlines.values())
 
     def trigger_pile(self, scheme: TriggerScheme) -> None:
         """Triggers a pile of cameras (cameras are piled by their trigger
         scheme)"""
-        for camera in self._trigger_piles[scheme]:
+        # Iterate over a copy, cameras can change their scheme meanwhile
+        for camera in tuple(self._trigger_piles[scheme].values()):
             try:
                 camera.trigger_a_photo()
             except CameraBusy:
@@ -152,40 +207,95 @@ class CameraController:
     def scheme_handler(self, camera: Camera, old: TriggerScheme,
                        new: TriggerScheme) -> None:
         """Transfers cameras between the triggering scheme piles"""
-        self._trigger_piles[old].remove(camera)
-        self._trigger_piles[new].add(camera)
+        self._trigger_piles[old].pop(camera.camera_id, None)
+        self._trigger_piles[new][camera.camera_id] = camera
 
     def photo_handler(self, snapshot: Snapshot) -> None:
         """Puts a snapshot received from the callback into a queue
-        for sending"""
+        for sending
+        If the queue is full, the oldest snapshot gets dropped"""
         if not snapshot.is_sendable():
             return
-        self.snapshot_queue.put(snapshot)
+        self._enqueue(snapshot)
+
+    def _enqueue(self, item: Optional[Snapshot]) -> None:
+        """Puts an item into the snapshot queue, makes space by dropping
+        the oldest snapshot. None wakes up the loop to see it's stopped and
+        is never dropped, snapshots coming after it are"""
+        while True:
+            try:
+                self.snapshot_queue.put_nowait(item)
+                return
+            except Full:
+                try:
+                    dropped = self.snapshot_queue.get_nowait()
+                except Empty:
+                    continue
+                if dropped is None:
+                    item = None
+                else:
+                    log.debug("Snapshot queue full, dropped a snapshot of %s",
+                              dropped.camera_id)
 
     def snapshot_loop(self) -> None:
-        """Gets an item Snapshot from queue and sends it"""
+        """Gets Snapshot items from queue and hands them to a pool
+        of senders, until stopped"""
         self._running = True
-        while self._running:
-            try:
-                # Get the item to send
-                item = self.snapshot_queue.get(timeout=TIMESTAMP_PRECISION)
-
-                # Send it
-                res = item.send(self.session, self.server)
-                if res.status_code in (401, 403):
-                    log.error("Failed to authorize request, "
-                              "resetting camera token")
-                    self.get_camera(item.camera_id).set_token(None)
-                if res.status_code > 400:
-                    log.warning(res.text)
-                elif res.status_code == 400:
-                    log.debug(res.text)
-            except Empty:
-                continue
-            except Exception:  # pylint: disable=broad-except
-                log.exception(
-                    "Unexpected exception caught in SDK snapshot loop!")
+        # Do not take snapshots off the queue faster than they can be sent,
+        # it's the queue that drops the stale ones. One snapshot per sender
+        # can wait in the pool, so the senders don't idle between uploads
+        free_senders = BoundedSemaphore(2 * SNAPSHOT_SENDERS)
+        pool = ThreadPoolExecutor(max_workers=SNAPSHOT_SENDERS,
+                                  thread_name_prefix="SnapshotSender")
+        try:
+            while True:
+                free_senders.acquire()  # pylint: disable=consider-using-with
+                if not self._running:
+                    break
+                # Block until there's something to do, stop() wakes us up
+                item = self.snapshot_queue.get()
+                if not self._running:
+                    break
+                if item is None:  # Left behind by an earlier stop()
+                    free_senders.release()
+                    continue
+                future = pool.submit(self._send_snapshot, item)
+                future.add_done_callback(lambda _: free_senders.release())
+        finally:
+            # Don't send the snapshots waiting in the pool,
+            # wait only for the ones being sent
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def _send_snapshot(self, item: Snapshot) -> None:
+        """Sends a snapshot, runs in the snapshot sender pool"""
+        if not self._running:
+            return
+        try:
+            res = item.send(self.session, self.server)
+            if res.status_code in (401, 403):
+                log.error("Failed to authorize request, "
+                          "resetting camera token")
+                self.get_camera(item.camera_id).set_token(None)
+            # Decoding the response text can need charset detection,
+            # only do it when it's going to get logged
+            if res.status_code > 400:
+                if log.isEnabledFor(logging.WARNING):
+                    log.warning("%s", res.text)
+            elif res.status_code == 400:
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug("%s", res.text)
+        except Exception:  # pylint: disable=broad-except
+            log.exception("Unexpected exception caught in SDK snapshot loop!")
 
     def stop(self) -> None:
-        """Signals to the loop to stop"""
+        """Signals to the loop to stop. Queued snapshots and the ones
+        waiting in the sender pool are discarded, only the uploads
+        already in progress get finished"""
         self._running = False
+        while True:
+            try:
+                self.snapshot_queue.get_nowait()
+            except Empty:
+                break
+        # Wake up the loop, if it's waiting for a snapshot
+        self._enqueue(None)
@@ -1,12 +1,21 @@
 """Implementation of the base CameraDriver"""
 
 import base64
-import hashlib
 import logging
-from copy import deepcopy
-from threading import Thread
+from hashlib import blake2b
+from queue import Queue
+from threading import Lock, Thread
 from types import MappingProxyType
-from typing import Callable, Dict, Iterable, Optional, Set
+from typing import (
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Mapping,
+    Optional,
+    Set,
+    Union,
+)
 
 from . import get_timestamp
 from .camera import Resolution, Snapshot
@@ -37,6 +46,13 @@ class CameraDriver:
     # Keys are the keys of the dictionary needed to instance the driver
     # Values are human-readable hints.
     REQUIRES_SETTINGS: MappingProxyType[str, str] = MappingProxyType({})
+    # Filled in for each driver class from the above, do not override
+    _required_settings: FrozenSet[str] = frozenset(ALWAYS_REQURIED)
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._required_settings = frozenset(ALWAYS_REQURIED).union(
+            cls.REQUIRES_SETTINGS)
 
     def __init__(self, camera_id: str, config: Dict[str, str],
                  disconnected_cb: Callable[["CameraDriver"], None]) -> None:
@@ -50,9 +66,13 @@ class CameraDriver:
         self.disconnected_cb = disconnected_cb
         self.store_cb: Callable[[str], None] = lambda camera_id: None
 
-        self._photo_thread: Optional[Thread] = None
+        # Photo requests for the photographer thread, None if not running
+        # pylint: disable=unsubscriptable-object
+        self._photo_requests: Optional[Queue[Optional[Snapshot]]] = None
+        self._photographer_lock = Lock()
         self._camera_id = camera_id
-        self._config = config
+        # Own copy, the driver updates it and hands out copies
+        self._config = dict(config)
 
         if not hasattr(self, "name"):
             raise ValueError("Name your driver - redefine class var 'name'")
@@ -61,6 +81,9 @@ class CameraDriver:
 
         self._capabilities: Set[CapabilityType] = set()
         self._available_resolutions: Set[Resolution] = set()
+        # Immutable copies of the above, rebuilt only when they differ
+        self._capabilities_view: FrozenSet[CapabilityType] = frozenset()
+        self._available_resolutions_view: FrozenSet[Resolution] = frozenset()
         # For web to show a preview even if the camera does not work right now
         self._last_snapshot: Optional[Snapshot] = None
 
@@ -95,11 +118,14 @@ class CameraDriver:
         return configured_resolution
 
     @staticmethod
-    def make_hash(plaintext_id: str) -> str:
-        """Hashes the camera ID"""
-        hashed_id = hashlib.blake2b(plaintext_id.encode("latin-1"),
-                                    digest_size=9).digest()
-        return base64.urlsafe_b64encode(hashed_id).decode()
+    def make_hash(plaintext_id: Union[str, bytes]) -> str:
+        """Hashes the camera ID, str IDs get latin-1 encoded"""
+        if isinstance(plaintext_id, str):
+            plaintext_id = plaintext_id.encode("latin-1")
+        # 72 bits are plenty for the handful of cameras a printer can have
+        hashed_id = blake2b(plaintext_id, digest_size=9).digest()
+        # The base64 alphabet is plain ASCII, skip the generic utf-8 codec
+        return base64.urlsafe_b64encode(hashed_id).decode("ascii")
 
     @classmethod
     def scan(cls) -> CameraConfigs:
@@ -137,13 +163,10 @@ class CameraDriver:
         return {}
 
     @classmethod
-    def get_required_settings(cls) -> Set[str]:
+    def get_required_settings(cls) -> FrozenSet[str]:
         """Returns the sum of always required and driver specific
         config options"""
-        required: Set[str] = set()
-        required.update(ALWAYS_REQURIED)
-        required.update(cls.REQUIRES_SETTINGS)
-        return required
+        return cls._required_settings
 
     @classmethod
     def get_config_hash(cls, config):
@@ -156,19 +179,19 @@ class CameraDriver:
                 continue
             config_values.append(key)
             config_values.append(config[key])
-        config_string = "".join(config_values)
-        return cls.make_hash(config_string)
+        # One join and one encode of the whole thing is the cheapest way
+        # to get the bytes to hash
+        return cls.make_hash("".join(config_values).encode("latin-1"))
 
     @classmethod
-    def is_config_valid(cls, config: Dict[str, str]) -> bool:
+    def is_config_valid(cls, config: Mapping[str, str]) -> bool:
         """
         Validates the supplied config, returns True if passed
         Override and add specific checks.
         Log failures, don't throw if possible,
         rather just call _disconnected()
         """
-        required: Set[str] = cls.get_required_settings()
-        missing_settings = required - set(config)
+        missing_settings = cls._required_settings - config.keys()
         if missing_settings:
             log.warning("The camera driver %s is missing these settings %s",
                         cls.name, ", ".join(missing_settings))
@@ -182,6 +205,7 @@ class CameraDriver:
             log.exception(
                 "Driver %s for a camera %s threw an error while "
                 "disconnecting", self.name, self.camera_id)
+        self._stop_photographer()
         if self._connected:
             # If we got stuck taking a photo and are returning late, the
             # driver is already stopped, so we must not call the disconnected
@@ -219,19 +243,42 @@ class CameraDriver:
         not_implemented(self, "focus")
 
     def trigger(self, snapshot: Optional[Snapshot] = None) -> None:
-        """This method is not allowed to block, it just
-        creates a new thread and runs it"""
+        """This method is not allowed to block, it just hands
+        the snapshot to the photographer thread, starting it if needed"""
         if snapshot is None:
             snapshot = Snapshot()
             snapshot.camera_id = self.camera_id
-        self._photo_thread = Thread(target=self._photo_taker,
-                                    args=(snapshot, ),
-                                    name="Photographer",
-                                    daemon=True)
-        self._photo_thread.start()
+        with self._photographer_lock:
+            if self._photo_requests is None:
+                self._photo_requests = Queue()
+                Thread(target=self._photographer,
+                       args=(self._photo_requests, ),
+                       name="Photographer",
+                       daemon=True).start()
+            self._photo_requests.put(snapshot)
+
+    def _photographer(self, photo_requests: Queue[Optional[Snapshot]]) -> None:
+        """The thread target, takes the requested photos one by one
+        until it gets None"""
+        while True:
+            snapshot = photo_requests.get()
+            if snapshot is None:
+                return
+            # Keep going, later photos can't be left waiting for nobody
+            try:
+                self._photo_taker(snapshot)
+            except Exception:  # pylint: disable=broad-except
+                log.exception("Handling a photo from %s failed", self.name)
+
+    def _stop_photographer(self) -> None:
+        """Lets the photographer thread finish its photos and quit"""
+        with self._photographer_lock:
+            if self._photo_requests is not None:
+                self._photo_requests.put(None)
+                self._photo_requests = None
 
     def _photo_taker(self, snapshot: Snapshot) -> None:
-        """The thread target, calls the blocking photo taking method and
+        """Calls the blocking photo taking method and
         catches errors. If a camera errors out while taking a photo it's
         considered disconnected"""
         try:
@@ -287,16 +334,22 @@ class CameraDriver:
         The capabilities supported by the device
         The minimum is supporting TRIGGER_SCHEME (ability to trigger a camera)
         """
-        return deepcopy(self._capabilities)
+        if self._capabilities_view != self._capabilities:
+            self._capabilities_view = frozenset(self._capabilities)
+        return self._capabilities_view
 
     @property
     def available_resolutions(self) -> Iterable[Resolution]:
         """Returns the available resolutions of the camera"""
-        return deepcopy(self._available_resolutions)
+        if self._available_resolutions_view != self._available_resolutions:
+            self._available_resolutions_view = frozenset(
+                self._available_resolutions)
+        return self._available_resolutions_view
 
     @property
     def config(self) -> Dict[str, str]:
         """
-        A dictionary with all the supported camera setting defaults
+        A copy of the dictionary with all the supported camera
+        setting defaults
         """
-        return deepcopy(self._config)
+        return dict(self._config)
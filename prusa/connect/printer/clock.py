@@ -4,6 +4,8 @@ import time
 
 # pylint: disable=too-many-instance-attributes
 
+NS_PER_SECOND = 1_000_000_000
+
 
 class ClockWatcher:
     """Check if the clock has been adjusted by comparing the
@@ -17,19 +19,36 @@ class ClockWatcher:
     TOLERANCE = 1  # seconds
 
     def __init__(self):
-        self.delta = 0
+        # The clocks are compared in integer nanoseconds
+        self._tolerance_ns = self.TOLERANCE * NS_PER_SECOND
+        self._delta_ns = 0
         self.reset()
 
+    @property
+    def delta(self):
+        """The measured delta in seconds"""
+        return self._delta_ns / NS_PER_SECOND
+
+    @delta.setter
+    def delta(self, delta):
+        self._delta_ns = round(delta * NS_PER_SECOND)
+
     def reset(self):
         """Reset the measured delta"""
-        self.delta = time.time() - time.monotonic()
+        self._delta_ns = self._current_delta_ns()
 
     def clock_adjusted(self):
         """Check if the clock has been adjusted on the system"""
-        return abs(self.delta - self.current_delta()) >= self.TOLERANCE
+        return abs(self._delta_ns -
+                   self._current_delta_ns()) >= self._tolerance_ns
 
     @staticmethod
     def current_delta():
         """Return the difference between the current time from EPOCH and
         HW clock. Both values are in seconds."""
-        return time.time() - time.monotonic()
+        return ClockWatcher._current_delta_ns() / NS_PER_SECOND
+
+    @staticmethod
+    def _current_delta_ns():
+        """Same as current_delta, in nanoseconds"""
+        return time.time_ns() - time.monotonic_ns()
@@ -1,6 +1,6 @@
 """Command class representation."""
 from logging import getLogger
-from multiprocessing import Event
+from threading import Event
 from typing import Any, Callable, Dict, List, Optional
 
 from . import const
@@ -15,6 +15,9 @@ log = getLogger("connect-printer")
 
 CommandArgs = Optional[List[Any]]
 
+# Command names as sent by Connect, resolved without going through the enum
+COMMAND_BY_NAME = {command.value: command for command in const.Command}
+
 
 class CommandFailed(RuntimeError):
     """Exception class for signalling that a command has failed."""
@@ -23,6 +26,10 @@ class CommandFailed(RuntimeError):
 class Command:
     """Command singleton/state like structure."""
 
+    __slots__ = ("args", "cmd_end_evt", "command_id", "command_name",
+                 "event_cb", "force", "handlers", "kwargs", "last_state",
+                 "new_cmd_evt", "state", "stop_cb")
+
     state: Optional[const.Event]
     command_name: Optional[str]
     args: Optional[List[Any]]
@@ -51,8 +58,7 @@ class Command:
         Otherwise, put right event to queue.
         """
         try:
-            command_enum = const.Command(command_name)
-            if command_enum in PRIORITY_COMMANDS:
+            if COMMAND_BY_NAME.get(command_name) in PRIORITY_COMMANDS:
                 self.stop_cb()
                 if not self.cmd_end_evt.wait(ONE_SECOND_TIMEOUT):
                     log.warning(
@@ -160,16 +166,14 @@ class Command:
             return None
 
         log.debug("Try to handle %s command.", self.command_name)
-        handler = None
         # Remember the current command id during this specific command's run
         command_id = self.command_id
-        try:
-            cmd = const.Command(self.command_name)
-            handler = self.handlers[cmd]
-        except ValueError:
+        cmd = COMMAND_BY_NAME.get(self.command_name)
+        if cmd is None:
             log.error("Unknown printer command %s", self.command_name)
             return self.reject(const.Source.WUI, reason="Unknown command")
-        except KeyError:
+        handler = self.handlers.get(cmd)
+        if handler is None:
             log.error("Printer command %s not implemented", self.command_name)
             return self.reject(const.Source.WUI, reason="Not Implemented")
         try:
@@ -10,6 +10,12 @@ GCODE_EXTENSIONS = (".gcode", ".gc", ".g", ".gco")
 FIRMWARE_EXTENSION = ".hex"
 SL_EXTENSIONS = (".sl1", )
 CAMERA_BUSY_TIMEOUT = 20  # 20s
+# How many snapshots can wait for sending, the oldest ones get dropped
+SNAPSHOT_QUEUE_SIZE = 32
+# Connections kept alive for sending snapshots
+SNAPSHOT_POOL_SIZE = 32
+# How many snapshots can be sent at once
+SNAPSHOT_SENDERS = 4
 
 # Maximum length of filename, including .gcode suffix
 FILENAME_LENGTH = 248
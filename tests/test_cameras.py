@@ -1,12 +1,13 @@
 """Implements test for the camera related modules"""
 from configparser import ConfigParser
-from threading import Barrier, Event
+from threading import Barrier, Event, Thread, current_thread
 from types import MappingProxyType
 from typing import ClassVar
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 
 import pytest
 from _pytest.python_api import raises
+from requests.exceptions import ConnectionError as RequestsConnectionError
 
 from prusa.connect.printer import get_timestamp
 from prusa.connect.printer.camera import Camera, Resolution, Snapshot
@@ -14,6 +15,8 @@ from prusa.connect.printer.camera_configurator import CameraConfigurator
 from prusa.connect.printer.camera_controller import CameraController
 from prusa.connect.printer.camera_driver import CameraDriver
 from prusa.connect.printer.const import (
+    SNAPSHOT_QUEUE_SIZE,
+    SNAPSHOT_SENDERS,
     CapabilityType,
     DriverError,
     NotSupported,
@@ -175,6 +178,7 @@ def test_humpty_function():
     id1 = CameraDriver.make_hash("id1")
     id2 = CameraDriver.make_hash("id2")
     id3 = CameraDriver.make_hash("id3")
+    assert CameraDriver.make_hash(b"id1") == id1
     assert id1 in available
     assert id2 not in available
     assert id3 not in available
@@ -186,6 +190,13 @@ def test_humpty_function():
         camera = Camera(driver)
     driver = DummyDriver(id1, available[id1], Mock())
     driver.connect()
+    # The driver keeps its own config and only hands out copies
+    assert "resolution" not in available[id1]
+    driver.config["name"] = "Renamed"
+    assert driver.config["name"] != "Renamed"
+    # The immutable capability copies are rebuilt only on a change
+    assert driver.capabilities is driver.capabilities
+    assert driver.available_resolutions is driver.available_resolutions
     camera = Camera(driver)
     expected = {
         CapabilityType.TRIGGER_SCHEME,
@@ -198,6 +209,8 @@ def test_humpty_function():
     assert camera.trigger_scheme == TriggerScheme.THIRTY_SEC
     camera.resolution = sorted(camera.available_resolutions)[1]
     assert camera.resolution == Resolution(5, 5)
+    # Humpty can't rotate, this must not ask for the rotation
+    assert camera.output_resolution == Resolution(5, 5)
     assert driver.current_resolution == Resolution(5, 5)
     camera.photo_cb = EventSetMock()
     camera.trigger_a_photo()
@@ -255,6 +268,60 @@ def test_humpty_function():
     driver.disconnected_cb.assert_called_once()
 
 
+def test_driver_photographer():
+    """One photographer thread takes the photos until disconnected"""
+    driver = DummyDriver(
+        "id6", {
+            "name": "Busy camera",
+            "driver": "Humpty Dumpty",
+            "parameter": "very parametric",
+        }, Mock())
+    driver.connect()
+    driver.set_resolution(Resolution(3, 3))
+    photographers = []
+    done = Barrier(2)
+
+    def photo_cb(_):
+        photographers.append(current_thread())
+        done.wait(1)
+
+    driver.photo_cb = photo_cb
+    for _ in range(3):
+        driver.trigger()
+        done.wait(1)
+    assert len(set(photographers)) == 1
+    driver.disconnect()
+    photographers[0].join(1)
+    assert not photographers[0].is_alive()
+
+
+def test_driver_photographer_survives_callback_error():
+    """A failing photo callback does not stop the following photos"""
+    driver = DummyDriver(
+        "id7", {
+            "name": "Clumsy camera",
+            "driver": "Humpty Dumpty",
+            "parameter": "very parametric",
+        }, Mock())
+    driver.connect()
+    driver.set_resolution(Resolution(3, 3))
+    delivered = Event()
+    photos = []
+
+    def photo_cb(snapshot):
+        photos.append(snapshot)
+        if len(photos) == 1:
+            raise RuntimeError("Dropped the photo")
+        delivered.set()
+
+    driver.photo_cb = photo_cb
+    driver.trigger()
+    driver.trigger()
+    assert delivered.wait(1)
+    assert len(photos) == 2
+    driver.disconnect()
+
+
 def test_configurator_from_config():
     id1 = CameraDriver.make_hash("id1")
     config = ConfigParser()
@@ -314,6 +381,89 @@ def test_configurator_from_config():
     assert configurator.order == ["derp", str(id1), "bar"]
 
 
+def test_configurator_order_numbering():
+    """Tests that the stored order is sorted by number, not as text"""
+    config = ConfigParser()
+    config.read_dict({
+        "camera_order": {str(index): f"cam{index}"
+                         for index in range(1, 12)},
+    })
+    config.read_dict({
+        f"camera::cam{index}": {
+            "name": f"Camera number {index}",
+            "driver": "Humpty Dumpty",
+            "parameter": "fall over",
+        }
+        for index in range(1, 12)
+    })
+    configurator = CameraConfigurator(CameraController(Mock(), "", Mock()),
+                                      config,
+                                      "/dev/null",
+                                      drivers=[DummyDriver],
+                                      auto_detect=False)
+    assert configurator.order == [f"cam{index}" for index in range(1, 12)]
+
+
+def test_configurator_forgets_unknown_order():
+    """Tests that all unknown cameras get removed from the order,
+    even the ones right next to each other"""
+    config = ConfigParser()
+    config.read_dict({
+        "camera_order": {
+            "1": "gone",
+            "2": "also gone",
+            "3": "cam",
+        },
+        "camera::cam": {
+            "name": "The only one left",
+            "driver": "Humpty Dumpty",
+            "parameter": "fall over",
+        },
+    })
+    configurator = CameraConfigurator(CameraController(Mock(), "", Mock()),
+                                      config,
+                                      "/dev/null",
+                                      drivers=[DummyDriver],
+                                      auto_detect=False)
+    assert configurator.order == ["cam"]
+
+
+def test_configurator_set_order():
+    """Tests that set_order moves known cameras to the front"""
+    config = ConfigParser()
+    config.read_dict({
+        "camera_order": {
+            "1": "a",
+            "2": "b",
+            "3": "c",
+        },
+    })
+    config.read_dict({
+        f"camera::{camera_id}": {
+            "name": f"Camera {camera_id}",
+            "driver": "Humpty Dumpty",
+            "parameter": "stand still",
+        }
+        for camera_id in ("a", "b", "c")
+    })
+    controller = CameraController(Mock(), "", Mock())
+    configurator = CameraConfigurator(controller,
+                                      config,
+                                      "/dev/null",
+                                      drivers=[DummyDriver],
+                                      auto_detect=False)
+    configurator.set_order(["c", "unknown", "b", "c"])
+    assert configurator.order == ["c", "b", "a"]
+    assert controller._camera_order == ("c", "b", "a")
+    assert [camera.camera_id
+            for camera in controller.cameras_in_order] == ["c", "b", "a"]
+    assert dict(config.items("camera_order")) == {
+        "1": "c",
+        "2": "b",
+        "3": "a",
+    }
+
+
 def test_duplicates():
     id1 = CameraDriver.make_hash("id1")
     config = ConfigParser()
@@ -340,6 +490,127 @@ def test_duplicates():
     assert not configurator.is_connected("same_cfg_as_id1")
 
 
+def test_configurator_writes_config(tmp_path):
+    """Tests that the config gets written out without leaving the
+    temporary file behind"""
+    config_file_path = str(tmp_path / "cameras.ini")
+    configurator = CameraConfigurator(CameraController(Mock(), "", Mock()),
+                                      ConfigParser(),
+                                      config_file_path,
+                                      drivers=[DummyDriver])
+    configurator.add_camera(
+        "abc", {
+            "name": "Written camera",
+            "driver": "Humpty Dumpty",
+            "parameter": "Nothing special",
+        })
+    written = ConfigParser()
+    written.read(config_file_path)
+    assert written.get("camera::abc", "name") == "Written camera"
+    assert "abc" in written["camera_order"].values()
+    assert [path.name for path in tmp_path.iterdir()] == ["cameras.ini"]
+
+    # Writing the same config again gets skipped
+    (tmp_path / "cameras.ini").unlink()
+    configurator._dirty = True
+    with configurator._batched_write():
+        pass
+    assert not (tmp_path / "cameras.ini").exists()
+
+
+def test_configurator_write_keeps_file(tmp_path):
+    """Tests that writing the config keeps a symlink and the file mode,
+    and cleans up after a failed write"""
+    real_path = tmp_path / "real.ini"
+    real_path.touch()
+    real_path.chmod(0o600)
+    link_path = tmp_path / "cameras.ini"
+    link_path.symlink_to(real_path)
+    configurator = CameraConfigurator(CameraController(Mock(), "", Mock()),
+                                      ConfigParser(),
+                                      str(link_path),
+                                      drivers=[DummyDriver])
+    configurator.add_camera(
+        "abc", {
+            "name": "Linked camera",
+            "driver": "Humpty Dumpty",
+            "parameter": "Nothing special",
+        })
+    assert link_path.is_symlink()
+    written = ConfigParser()
+    written.read(real_path)
+    assert written.get("camera::abc", "name") == "Linked camera"
+    assert real_path.stat().st_mode & 0o777 == 0o600
+
+    configurator.config.set("camera::abc", "name", "Renamed camera")
+    with patch("os.fsync", side_effect=OSError):
+        with raises(OSError):
+            configurator._write_config()
+    names = sorted(path.name for path in tmp_path.iterdir())
+    assert names == ["cameras.ini", "real.ini"]
+
+
+def test_configurator_batches_writes(tmp_path):
+    """Tests that a single operation writes the config only once"""
+    configurator = CameraConfigurator(CameraController(Mock(), "", Mock()),
+                                      ConfigParser(),
+                                      str(tmp_path / "cameras.ini"),
+                                      drivers=[DummyDriver])
+    write_config = Mock(wraps=configurator._write_config)
+    configurator._write_config = write_config
+    configurator.add_camera(
+        "abc", {
+            "name": "Batched camera",
+            "driver": "Humpty Dumpty",
+            "parameter": "Nothing special",
+        })
+    write_config.assert_called_once()
+    # The driver has added its own settings on connect
+    configurator.store("abc")
+    write_config.reset_mock()
+    # Nothing changes, nothing gets written
+    store_config = Mock(wraps=configurator._store_config)
+    configurator._store_config = store_config
+    configurator.store("abc")
+    configurator.store_order()
+    write_config.assert_not_called()
+    store_config.assert_not_called()
+    configurator.remove_camera("abc")
+    write_config.assert_called_once()
+
+
+def test_configurator_parallel_scan():
+    """Tests that drivers scan for cameras at the same time"""
+    barrier = Barrier(2)
+
+    class SlowDriver(DummyDriver):
+        """Scans only if the other driver scans at the same time"""
+        name = "Slow Humpty"
+
+        @classmethod
+        def _scan(cls):
+            barrier.wait(1)
+            return {
+                cls.name: {
+                    "name": f"Camera from {cls.name}",
+                    "parameter": "fall over",
+                },
+            }
+
+    class SlowerDriver(SlowDriver):
+        """The other one"""
+        name = "Slower Humpty"
+
+    configurator = CameraConfigurator(CameraController(Mock(), "", Mock()),
+                                      ConfigParser(),
+                                      "/dev/null",
+                                      drivers=[SlowDriver, SlowerDriver])
+    assert configurator.detected == {
+        CameraDriver.make_hash("Slow Humpty"),
+        CameraDriver.make_hash("Slower Humpty"),
+    }
+
+
 def test_configurator_auto_add():
     configurator = CameraConfigurator(CameraController(Mock(), "", Mock()),
                                       ConfigParser(),
@@ -369,8 +640,9 @@ def test_configurator_auto_add():
 
 
 def test_configurator_remove():
+    config = ConfigParser()
     configurator = CameraConfigurator(CameraController(Mock(), "", Mock()),
-                                      ConfigParser(),
+                                      config,
                                       "/dev/null",
                                       drivers=[DummyDriver])
     configurator.add_camera(
@@ -381,7 +653,12 @@ def test_configurator_remove():
         })
     assert "def" in configurator.loaded
     assert "def" in configurator.camera_controller
+    assert config.has_section("camera::def")
+    assert configurator._section_cache["camera::def"] == dict(
+        config.items("camera::def"))
     configurator.remove_camera("def")
+    assert not config.has_section("camera::def")
+    assert "camera::def" not in configurator._section_cache
     assert "def" not in configurator.loaded
     assert "def" not in configurator.order
     assert "def" not in configurator.stored
@@ -415,10 +692,16 @@ def test_reset_settings():
         })
     assert "def" in configurator.loaded
     assert "extra_garbage" in configurator.loaded["def"].config
+    old_driver = configurator.loaded["def"]
     configurator.reset_to_defaults("def")
     assert "def" in configurator.loaded
     assert "extra_garbage" not in configurator.loaded["def"].config
 
+    # The replaced driver reporting a disconnect late changes nothing
+    configurator._disconnected_handler(old_driver)
+    assert configurator.is_connected("def")
+    assert "def" in configurator.camera_controller
+
 
 def test_add_more():
     """Tests that if a new camera becomes available, calling load_cameras()
@@ -484,15 +767,18 @@ def test_camera_controller():
     camera_id1.wait_ready(0.1)
     camera_abc.wait_ready(0.1)
 
-    assert camera_abc in controller._trigger_piles[TriggerScheme.MANUAL]
+    assert camera_abc.camera_id in controller._trigger_piles[
+        TriggerScheme.MANUAL]
 
     camera_id1.trigger_scheme = TriggerScheme.TEN_SEC
     camera_id1.resolution = Resolution(RES_BOTH, RES_BOTH)
     camera_abc.trigger_scheme = TriggerScheme.TEN_SEC
     camera_abc.resolution = Resolution(RES_BOTH, RES_BOTH)
 
-    assert camera_id1 in controller._trigger_piles[TriggerScheme.TEN_SEC]
-    assert camera_abc in controller._trigger_piles[TriggerScheme.TEN_SEC]
+    assert camera_id1.camera_id in controller._trigger_piles[
+        TriggerScheme.TEN_SEC]
+    assert camera_abc.camera_id in controller._trigger_piles[
+        TriggerScheme.TEN_SEC]
 
     barrier = Barrier(3)
     barrier_mock = Mock()
@@ -519,7 +805,28 @@ def test_camera_controller():
 
     camera_abc.wait_ready(0.1)
     camera_abc.trigger_scheme = TriggerScheme.EACH_LAYER
-    assert camera_abc in controller._trigger_piles[TriggerScheme.EACH_LAYER]
+    assert camera_abc.camera_id in controller._trigger_piles[
+        TriggerScheme.EACH_LAYER]
+
+
+def test_camera_controller_tick():
+    """Only the time schemes past their deadline get triggered"""
+    controller = CameraController(Mock(), "", Mock())
+    controller.trigger_pile = Mock()
+    controller.tick()
+    controller.trigger_pile.assert_not_called()
+
+    controller._trigger_deadlines[TriggerScheme.TEN_SEC] = 0
+    controller.tick()
+    # Nothing else is due yet, so the scheme deadlines don't get checked
+    controller.trigger_pile.assert_not_called()
+    controller._next_deadline = 0
+    controller.tick()
+    controller.trigger_pile.assert_called_once_with(TriggerScheme.TEN_SEC)
+    assert controller._trigger_deadlines[TriggerScheme.TEN_SEC] > 0
+    assert controller._next_deadline > 0
+    controller.tick()
+    controller.trigger_pile.assert_called_once()
 
 
 def test_passing_printer_uuid():
@@ -538,7 +845,8 @@ def test_passing_printer_uuid():
     camera_id1.wait_ready(0.1)
 
     camera_id1.trigger_scheme = TriggerScheme.MANUAL
-    assert camera_id1 in controller._trigger_piles[TriggerScheme.MANUAL]
+    assert camera_id1.camera_id in controller._trigger_piles[
+        TriggerScheme.MANUAL]
 
     barrier = Barrier(2)
     barrier_mock = Mock()
@@ -582,6 +890,18 @@ def test_setting_conversions():
     assert exported_settings == back_from_string
 
 
+def test_output_resolution():
+    enormous = CameraDriver.make_hash("EnormousCamera")
+    driver = GoodDriver(enormous, GoodDriver.scan()[enormous], Mock())
+    driver.connect()
+    camera = Camera(driver)
+    assert camera.output_resolution == Resolution(12288, 6480)
+    camera.rotation = 90
+    assert camera.output_resolution == Resolution(6480, 12288)
+    camera.rotation = 180
+    assert camera.output_resolution == Resolution(12288, 6480)
+
+
 @pytest.fixture()
 def snapshot():
     snapshot = Snapshot()
@@ -604,13 +924,52 @@ def test_snapshot(printer, snapshot):
     assert item.data == snapshot.data
 
 
+def test_snapshot_queue_drops_oldest(printer, snapshot):
+    camera_controller = printer.camera_controller
+    newest = Snapshot()
+    for attribute in ("camera_fingerprint", "camera_token", "camera_id",
+                      "timestamp"):
+        setattr(newest, attribute, getattr(snapshot, attribute))
+    newest.data = b'0101'
+
+    for _ in range(SNAPSHOT_QUEUE_SIZE):
+        camera_controller.photo_handler(snapshot)
+    camera_controller.photo_handler(newest)
+
+    queue = camera_controller.snapshot_queue
+    assert queue.qsize() == SNAPSHOT_QUEUE_SIZE
+    items = [queue.get_nowait() for _ in range(SNAPSHOT_QUEUE_SIZE)]
+    assert items[-1] is newest
+    assert all(item is snapshot for item in items[:-1])
+
+    # The stop request never gets dropped
+    camera_controller.stop()
+    for _ in range(SNAPSHOT_QUEUE_SIZE):
+        camera_controller.photo_handler(snapshot)
+    items = [queue.get_nowait() for _ in range(queue.qsize())]
+    assert items[-1] is None
+
+
 def test_snapshot_loop(requests_mock, printer, snapshot):
     camera_controller = printer.camera_controller
+    sent = Event()
 
-    requests_mock.put(SERVER + "/c/snapshot", status_code=204)
+    def callback(*_):
+        sent.set()
+        return ""
 
+    requests_mock.put(SERVER + "/c/snapshot", status_code=204, text=callback)
+
+    # A stop without a running loop must not stop the next one
+    camera_controller.stop()
+    thread = Thread(target=camera_controller.snapshot_loop)
+    thread.start()
     camera_controller.photo_handler(snapshot)
-    run_loop(camera_controller.snapshot_loop)
+    assert sent.wait(1)
+    camera_controller.stop()
+    thread.join(1)
+    assert not thread.is_alive()
+
     req = requests_mock.request_history[0]
     assert (str(req) == f"PUT {SERVER}/c/snapshot")
     assert req.headers["Fingerprint"] == snapshot.camera_fingerprint
@@ -618,6 +977,77 @@ def test_snapshot_loop(requests_mock, printer, snapshot):
     assert req.headers["Content-Length"] == str(len(snapshot.data))
 
 
+def test_snapshot_loop_sends_in_parallel(printer, snapshot):
+    camera_controller = printer.camera_controller
+    # Two senders and this test
+    barrier = Barrier(3, timeout=1)
+
+    def request(**_):
+        barrier.wait()
+        return Mock(status_code=204)
+
+    camera_controller.session = Mock(request=Mock(side_effect=request))
+    camera_controller.photo_handler(snapshot)
+    camera_controller.photo_handler(snapshot)
+    thread = Thread(target=camera_controller.snapshot_loop)
+    thread.start()
+    barrier.wait()
+    camera_controller.stop()
+    thread.join(1)
+    assert not thread.is_alive()
+    assert camera_controller.session.request.call_count == 2
+
+
+def test_snapshot_loop_stop(printer, snapshot):
+    """Stopping does not wait for the queued snapshots to get sent"""
+    camera_controller = printer.camera_controller
+    # All the senders and this test
+    in_flight = Barrier(SNAPSHOT_SENDERS + 1, timeout=1)
+    finish = Event()
+
+    def request(**_):
+        in_flight.wait()
+        finish.wait(1)
+        return Mock(status_code=204)
+
+    camera_controller.session = Mock(request=Mock(side_effect=request))
+    for _ in range(SNAPSHOT_QUEUE_SIZE):
+        camera_controller.photo_handler(snapshot)
+    thread = Thread(target=camera_controller.snapshot_loop)
+    thread.start()
+    in_flight.wait()
+    camera_controller.stop()
+    finish.set()
+    thread.join(1)
+    assert not thread.is_alive()
+    assert camera_controller.session.request.call_count == \
+        SNAPSHOT_SENDERS
+    # Only the wake-up call is left in the queue
+    queue = camera_controller.snapshot_queue
+    assert [queue.get_nowait() for _ in range(queue.qsize())] == [None]
+
+
+def test_snapshot_adapter(printer):
+    """The snapshot adapter is used only for snapshots and follows
+    the server URL"""
+    camera_controller = printer.camera_controller
+    adapter = printer.conn.get_adapter(SERVER + "/c/snapshot")
+    assert adapter.max_retries.total == 3
+    assert printer.conn.get_adapter(SERVER + "/p/telemetry") is not adapter
+
+    camera_controller.server = "http://other"
+    assert printer.conn.get_adapter(SERVER + "/c/snapshot") is not adapter
+    assert printer.conn.get_adapter("http://other/c/snapshot") is adapter
+
+
+def test_printer_session_not_retried(printer):
+    with patch("urllib3.util.connection.create_connection",
+               side_effect=ConnectionRefusedError) as create_connection:
+        with raises(RequestsConnectionError):
+            printer.conn.post(SERVER + "/p/telemetry")
+    assert create_connection.call_count == 1
+
+
 def test_camera_register(printer):
     camera_controller = printer.camera_controller
     # Want to hold a reference but flake8 said NO